@@ -37,6 +37,7 @@ import cv2
 import random
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+import numba
 import numpy
 import os
 import os.path
@@ -62,6 +63,24 @@ import pickle
 import copy
 
 
+@numba.njit(fastmath=True, cache=True)
+def augmentProcessedImageKernel(image, noiseScale):
+    """
+        Applies the training augmentations to a processed image, in place. This adds gaussian noise to every
+        pixel and then clips the result to between 0 and 1. It runs on a single thread, since it is called from
+        many batch preparation worker processes at the same time.
+
+        :param image: A float32 numpy array of shape (channels, height, width)
+        :param noiseScale: The standard deviation of the gaussian noise
+    """
+    channels, height, width = image.shape
+    for channel in range(channels):
+        for y in range(height):
+            for x in range(width):
+                value = image[channel, y, x] + numpy.random.normal(0.0, noiseScale)
+                image[channel, y, x] = min(1.0, max(0.0, value))
+
+
 class DeepLearningAgent:
     """
         This class represents a deep learning agent, which is an agent that uses deep learning in order to learn how
@@ -74,14 +93,19 @@ class DeepLearningAgent:
 
         self.whichGpu = whichGpu
 
+        # This is the cuda stream used to copy prefetched batches onto the GPU. Its created lazily
+        # because the agent is also constructed in processes that never use the GPU.
+        self.copyStream = None
+
         # We create a method that will convert torch CPU tensors into
-        # torch CUDA tensors if this model is set in GPU mode.
+        # torch CUDA tensors if this model is set in GPU mode. Data that already arrives as
+        # a torch tensor is expected to be in pinned memory, so it can be copied asynchronously.
         if self.whichGpu == "all":
-            self.variableWrapperFunc = lambda t, x: t(x).cuda()
+            self.variableWrapperFunc = lambda t, x: x.to(device="cuda", dtype=t.dtype, non_blocking=True) if isinstance(x, torch.Tensor) else t(x).cuda()
         elif self.whichGpu is None:
-            self.variableWrapperFunc = lambda t, x: t(x)
+            self.variableWrapperFunc = lambda t, x: x.to(dtype=t.dtype) if isinstance(x, torch.Tensor) else t(x)
         else:
-            self.variableWrapperFunc = lambda t, x: t(x).cuda(device=f"cuda:{self.whichGpu}")
+            self.variableWrapperFunc = lambda t, x: x.to(device=f"cuda:{self.whichGpu}", dtype=t.dtype, non_blocking=True) if isinstance(x, torch.Tensor) else t(x).cuda(device=f"cuda:{self.whichGpu}")
 
         # Fetch the folder that we will store the model parameters in
         self.modelPath = os.path.join(config.getKwolaUserDataDirectory("models"), "deep_learning_model")
@@ -1814,13 +1838,11 @@ class DeepLearningAgent:
             :return: A new numpy array, with the same shape as the input processedImage, but now with data augmentations
                      applied.
         """
-        # Add random noise
-        augmentedImage = processedImage + numpy.random.normal(loc=0, scale=self.config['training_image_gaussian_noise_scale'], size=processedImage.shape)
+        # The kernel works on a float32 copy, since numba is unable to operate on float16 arrays
+        augmentedImage = numpy.array(processedImage, dtype=numpy.float32)
+        augmentProcessedImageKernel(augmentedImage.reshape((-1,) + augmentedImage.shape[-2:]), float(self.config['training_image_gaussian_noise_scale']))
 
-        # Clip the bounds to between 0 and 1
-        augmentedImage = numpy.maximum(numpy.zeros_like(augmentedImage), numpy.minimum(numpy.ones_like(augmentedImage), augmentedImage))
-
-        return augmentedImage
+        return augmentedImage.astype(processedImage.dtype, copy=False)
 
 
     def prepareBatchesForExecutionSession(self, executionSession):
@@ -1985,6 +2007,56 @@ class DeepLearningAgent:
             }
 
 
+    # These are the largest arrays in each batch, which are worth staging in pinned memory
+    # so that they can be transferred to the GPU without blocking, along with the tensor
+    # type they are converted into.
+    pinnedBatchKeys = {
+        'processedImages': torch.FloatTensor,
+        'nextProcessedImages': torch.FloatTensor,
+        'pixelActionMaps': torch.IntTensor,
+        'nextPixelActionMaps': torch.IntTensor,
+        'rewardPixelMasks': torch.IntTensor
+    }
+
+    @staticmethod
+    def pinBatchMemory(batch):
+        """
+            Converts the large image arrays within a prepared batch into torch tensors in page-locked memory,
+            so that learnFromBatches can copy them onto the GPU with non_blocking transfers.
+
+            :param batch: A batch dictionary, as produced by prepareEmptyBatch and the TrainingManager.
+            :return: The same batch dictionary, modified in place.
+        """
+        for key in DeepLearningAgent.pinnedBatchKeys:
+            batch[key] = torch.from_numpy(batch[key]).pin_memory()
+        return batch
+
+    def prefetchBatchesToDevice(self, batches):
+        """
+            Starts copying the pinned arrays of the given batches onto the GPU using a dedicated copy stream.
+            This returns immediately, so the copies can overlap with whatever the GPU is computing in the
+            meantime. learnFromBatches will wait for the copies to complete before using the data.
+
+            :param batches: A list of batches which have been through pinBatchMemory.
+            :return: The same list of batches, with the pinned arrays replaced by tensors on the GPU.
+        """
+        if self.whichGpu is None:
+            return batches
+
+        if self.copyStream is None:
+            self.copyStream = torch.cuda.Stream(priority=-1)
+
+        with torch.cuda.stream(self.copyStream):
+            for batch in batches:
+                for key, tensorType in self.pinnedBatchKeys.items():
+                    batch[key] = self.variableWrapperFunc(tensorType, batch[key])
+            copyEvent = self.copyStream.record_event()
+
+        for batch in batches:
+            batch['deviceCopyEvent'] = copyEvent
+
+        return batches
+
     def learnFromBatches(self, batches):
         """
             Runs backprop on the neural network with the given set of batches.
@@ -2026,6 +2098,13 @@ class DeepLearningAgent:
         self.optimizer.zero_grad()
 
         for batch in batches:
+            if 'deviceCopyEvent' in batch:
+                # The batch was prefetched on the copy stream, so we have to wait for those copies
+                # to finish, and tell the allocator that the memory is now in use on this stream.
+                torch.cuda.current_stream().wait_event(batch['deviceCopyEvent'])
+                for key in self.pinnedBatchKeys:
+                    batch[key].record_stream(torch.cuda.current_stream())
+
             # Here we create torch tensors out of literally all possible data we will need to do any calculations.
             # The reason its done all upfront like this is because this allows the code to pipeline the data it
             # is sending into the GPU. This ensures that all of the GPU calculations are done without any interruptions
@@ -2051,12 +2130,12 @@ class DeepLearningAgent:
             widthTensor = self.variableWrapperFunc(torch.IntTensor, [batch["processedImages"].shape[3]])
             heightTensor = self.variableWrapperFunc(torch.IntTensor, [batch["processedImages"].shape[2]])
             presentRewardsTensor = self.variableWrapperFunc(torch.FloatTensor, batch["presentRewards"])
-            processedImagesTensor = self.variableWrapperFunc(torch.FloatTensor, numpy.array(batch['processedImages']))
+            processedImagesTensor = self.variableWrapperFunc(torch.FloatTensor, batch['processedImages'])
             symbolIndexesTensor = self.variableWrapperFunc(torch.LongTensor, numpy.array(batch['symbolIndexes']))
             symbolListOffsetsTensor = self.variableWrapperFunc(torch.LongTensor, numpy.array(batch['symbolOffsets']))
             symbolWeightsTensor = self.variableWrapperFunc(torch.FloatTensor, numpy.array(batch['symbolWeights']))
             stepNumberTensor = self.variableWrapperFunc(torch.FloatTensor, batch['stepNumbers'])
-            nextProcessedImagesTensor = self.variableWrapperFunc(torch.FloatTensor, numpy.array(batch['nextProcessedImages']))
+            nextProcessedImagesTensor = self.variableWrapperFunc(torch.FloatTensor, batch['nextProcessedImages'])
             nextSymbolIndexesTensor = self.variableWrapperFunc(torch.LongTensor, numpy.array(batch['nextSymbolIndexes']))
             nextSymbolListOffsetsTensor = self.variableWrapperFunc(torch.LongTensor, numpy.array(batch['nextSymbolOffsets']))
             nextSymbolWeightsTensor = self.variableWrapperFunc(torch.FloatTensor, numpy.array(batch['nextSymbolWeights']))
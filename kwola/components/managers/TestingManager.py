@@ -178,7 +178,7 @@ class TestingManager:
         fileDescriptor, inferenceBatchFileName = tempfile.mkstemp()
 
         with open(fileDescriptor, 'wb') as file:
-            pickle.dump((self.step, images, envActionMaps, self.executionSessionTraceLocalPickleFiles), file)
+            pickle.dump((self.step, images, envActionMaps, self.executionSessionTraceLocalPickleFiles), file, protocol=pickle.HIGHEST_PROTOCOL)
 
         del images, envActionMaps
 
@@ -238,7 +238,7 @@ class TestingManager:
             trace.actionMaps = None
             fileDescriptor, traceFileName = tempfile.mkstemp()
             with open(fileDescriptor, 'wb') as file:
-                pickle.dump(trace, file)
+                pickle.dump(trace, file, protocol=pickle.HIGHEST_PROTOCOL)
             self.executionSessionTraceLocalPickleFiles[sessionN].append(traceFileName)
             trace.actionMaps = actionMaps
 
@@ -322,7 +322,7 @@ class TestingManager:
 
             resultFileDescriptor, resultFileName = tempfile.mkstemp()
             with open(resultFileDescriptor, 'wb') as file:
-                pickle.dump(actions, file)
+                pickle.dump(actions, file, protocol=pickle.HIGHEST_PROTOCOL)
 
             subProcessResultQueue.put(resultFileName)
 
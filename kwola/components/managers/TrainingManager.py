@@ -20,7 +20,7 @@
 
 
 from ...config.logger import getLogger, setupLocalLogging
-from ...components.agents.DeepLearningAgent import DeepLearningAgent
+from ...components.agents.DeepLearningAgent import DeepLearningAgent, augmentProcessedImageKernel
 from ...components.environments.WebEnvironment import WebEnvironment
 from ...tasks.TaskProcess import TaskProcess
 from ...config.config import KwolaCoreConfiguration
@@ -29,17 +29,22 @@ from ...datamodels.ExecutionTraceModel import ExecutionTrace
 from ...datamodels.TestingStepModel import TestingStep
 from ...datamodels.TrainingStepModel import TrainingStep
 from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
 import atexit
+import collections
 import concurrent.futures
 import gzip
 import json
 import billiard as multiprocessing
 import billiard.pool as multiprocessingpool
+import numba
 import numpy
 import os
 import pickle
-import random
-import scipy.special
+import queue
+import re
+import secrets
+import struct
 import sys
 import tempfile
 import time
@@ -57,7 +62,64 @@ def isNumpyArray(obj):
     return type(obj).__module__ == numpy.__name__
 
 
+# These are preallocated float32 image buffers, keyed by shape, which are reused by
+# each batch preparation worker process when augmenting the cropped images.
+augmentationBuffers = {}
+
+
+def getAugmentationBuffer(shape):
+    if shape not in augmentationBuffers:
+        augmentationBuffers[shape] = numpy.empty(shape, dtype=numpy.float32)
+    return augmentationBuffers[shape]
+
+
+@numba.njit(fastmath=True, cache=True)
+def computeTraceSelectionLogits(weights, minimumWeight, maximumWeight, oneSideBias, outLogits):
+    """
+        Computes the logits used to select execution traces for a batch from their weights. The weights are clamped
+        to between the minimum and maximum weight, and then a linearly increasing bias going from 0 up to oneSideBias
+        is added across the list of traces.
+
+        :param weights: A float64 numpy array containing the weight for each execution trace
+        :param minimumWeight: The minimum weight
+        :param maximumWeight: The maximum weight
+        :param oneSideBias: The bias added to the last trace in the list. Pass 0 for no bias.
+        :param outLogits: A float64 numpy array of the same length as weights which will receive the logits
+    """
+    n = weights.shape[0]
+    for index in range(n):
+        logit = max(minimumWeight, min(maximumWeight, weights[index]))
+        if n > 1:
+            logit += oneSideBias * index / (n - 1)
+        outLogits[index] = logit
+
+
+# This holds the arguments and objects shared by all tasks in a worker process. It is filled
+# in once by TrainingManager.initializeWorker or TrainingManager.initializeBatchPrepWorker when the worker starts.
+workerProcessState = {}
+
+
 class TrainingManager:
+    # The byte alignment used for each of the raw array buffers in the sample cache files
+    sampleCacheAlignment = 64
+
+    # The directory backing the shared memory segments used to hand samples between processes
+    sharedMemoryDirectory = "/dev/shm"
+
+    # These are the commands sent to the batch preparation sub processes. Each message on the command queue
+    # is a tuple starting with one of these, followed by the arguments for that command.
+    commandBatch, commandStarved, commandFull, commandQuit, commandUpdateLossBatch = range(5)
+
+    # This matches the file extensions that objects saved to disk can have, e.g. .json, .pickle or .pickle.gz
+    dataFileExtensionRegex = re.compile(r"(\.json|\.pickle)?(\.gz)?$")
+
+    # The variable length symbol arrays in each sample, grouped by the offsets key they share in a batch
+    symbolKeyFamilies = {
+        "symbolOffsets": ("symbolIndexes", "symbolWeights"),
+        "nextSymbolOffsets": ("nextSymbolIndexes", "nextSymbolWeights"),
+        "decayingFutureSymbolOffsets": ("decayingFutureSymbolIndexes", "decayingFutureSymbolWeights")
+    }
+
     def __init__(self, configDir, trainingSequenceId, trainingStepIndex, gpu=None, coordinatorTempFileName="kwola_distributed_coordinator", testingRunId=None, applicationId=None, gpuWorldSize=torch.cuda.device_count(), plugins=None):
         self.config = KwolaCoreConfiguration(configDir)
         self.configDir = configDir
@@ -74,20 +136,28 @@ class TrainingManager:
 
         self.totalBatchesNeeded = self.config['iterations_per_training_step'] * self.config['batches_per_iteration'] + int(self.config['training_surplus_batches'])
         self.batchesPrepared = 0
-        self.batchFutures = []
-        self.recentCacheHits = []
+        self.readyBatchFutures = queue.SimpleQueue()
+        # Only a running sum is kept for the statistics that get printed, so that computing
+        # them doesn't get slower as the training step goes on.
+        self.recentCacheHits = collections.deque(maxlen=self.config['print_cache_hit_rate_moving_average_length'])
+        self.recentCacheHitsSum = 0.0
         self.starved = False
         self.lastStarveStateAdjustment = 0
-        self.coreLearningTimes = []
+        self.coreLearningTimeSum = 0.0
+        self.coreLearningTimeCount = 0
+        self.printLossMovingAverageLength = int(self.config['print_loss_moving_average_length'])
+        self.pendingCoreLearningTimeEvents = []
 
         self.testingSteps = []
         self.agent = None
 
-        self.batchDirectory = None
         self.subProcessCommandQueues = []
         self.subProcessBatchResultQueues = []
         self.subProcesses = []
 
+        # Every shared memory segment created for this trainer's batches is named with this prefix
+        self.sharedMemoryPrefix = f"kwola_{os.getpid()}_"
+
         if plugins is None:
             self.plugins = []
         else:
@@ -116,18 +186,27 @@ class TrainingManager:
 
     def initializeGPU(self):
         if self.gpu is not None:
+            # The device has to be set before the process group is created, so that
+            # NCCL binds this rank to the correct GPU.
+            torch.cuda.set_device(self.gpu)
             for subprocessIndex in range(10):
                 try:
-                    torch.distributed.init_process_group(backend="gloo",
+                    torch.distributed.init_process_group(backend="nccl",
                                                          world_size=self.gpuWorldSize,
                                                          rank=self.gpu,
-                                                         init_method=f"file:///tmp/{self.coordinatorTempFileName}")
+                                                         init_method=f"file:///tmp/{self.coordinatorTempFileName}",
+                                                         device_id=torch.device(f'cuda:{self.gpu}'))
                     break
                 except RuntimeError:
+                    # With device_id set, NCCL creates its communicator eagerly, so a failure can leave a half
+                    # initialized default group behind. It has to be destroyed, otherwise the retry would fail
+                    # with "default process group already initialized" instead of the real error.
+                    if torch.distributed.is_initialized():
+                        torch.distributed.destroy_process_group()
                     time.sleep(1)
                     if subprocessIndex == 9:
                         raise
-            torch.cuda.set_device(self.gpu)
+            torch.distributed.barrier(device_ids=[self.gpu])
             getLogger().info(f"[{os.getpid()}] Cuda Ready on GPU {self.gpu}")
 
     def loadTestingSteps(self):
@@ -159,6 +238,13 @@ class TrainingManager:
             self.agent.initialize()
             self.agent.load()
 
+            if self.config['training_torch_compile']:
+                # The modules are compiled in place so that their state dicts keep the same keys,
+                # which is required for saving the model and for updating the target network.
+                getLogger().info(f"[{os.getpid()}] Compiling the neural networks with torch.compile")
+                self.agent.model.compile(mode='reduce-overhead', fullgraph=False)
+                self.agent.targetNetwork.compile(mode='reduce-overhead', fullgraph=False)
+
             self.createSubproccesses()
 
             for plugin in self.plugins:
@@ -173,16 +259,32 @@ class TrainingManager:
             self.threadExecutor = concurrent.futures.ThreadPoolExecutor(
                     max_workers=self.config['training_max_batch_prep_thread_workers'] * self.config['training_batch_prep_subprocesses'])
 
+            # The next iteration's batches are fetched on their own thread, so that fetching
+            # them never has to wait behind the batch loading tasks for a free worker.
+            self.prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
             self.queueBatchesForPrecomputation()
 
+            nextBatches = self.fetchAndPrefetchBatchesForIteration()
+
             while self.trainingStep.numberOfIterationsCompleted < self.config['iterations_per_training_step']:
                 self.updateBatchPrepStarvedState()
-                batches = self.fetchBatchesForIteration()
+                batches = nextBatches
+
+                nextBatchesFuture = None
+                if self.trainingStep.numberOfIterationsCompleted + 1 < self.config['iterations_per_training_step']:
+                    # The batches for the next iteration are fetched in the background and start copying onto the
+                    # GPU on a separate stream, so that both the wait and the transfer overlap with this iteration's
+                    # learning. This means a second iteration's worth of batches is held in GPU memory at a time.
+                    nextBatchesFuture = self.prefetchExecutor.submit(self.fetchAndPrefetchBatchesForIteration)
 
                 success = self.learnFromBatches(batches)
                 if not success:
                     break
 
+                if nextBatchesFuture is not None:
+                    nextBatches = nextBatchesFuture.result()
+
                 if self.trainingStep.numberOfIterationsCompleted % self.config['training_update_target_network_every'] == (self.config['training_update_target_network_every'] - 1):
                     getLogger().info(f"[{os.getpid()}] Updating the target network weights to the current primary network weights.")
                     self.agent.updateTargetNetwork()
@@ -192,10 +294,11 @@ class TrainingManager:
                 if self.trainingStep.numberOfIterationsCompleted % self.config['print_loss_iterations'] == (self.config['print_loss_iterations'] - 1):
                     if self.gpu is None or self.gpu == 0:
                         timePerBatch = (datetime.now() - self.trainingStep.startTime).total_seconds() / self.trainingStep.numberOfIterationsCompleted
-                        getLogger().info(f"[{os.getpid()}] Completed {self.trainingStep.numberOfIterationsCompleted + 1} batches. Average time per batch: {timePerBatch:.3f}. Core learning time: {numpy.average(self.coreLearningTimes):.3f}")
+                        self.collectCoreLearningTimes()
+                        getLogger().info(f"[{os.getpid()}] Completed {self.trainingStep.numberOfIterationsCompleted + 1} batches. Average time per batch: {timePerBatch:.3f}. Core learning time: {self.coreLearningTimeSum / max(1, self.coreLearningTimeCount):.3f}")
                         self.printMovingAverageLosses()
                         if self.config['print_cache_hit_rate']:
-                            getLogger().info(f"[{os.getpid()}] Batch cache hit rate {100 * numpy.mean(self.recentCacheHits[-self.config['print_cache_hit_rate_moving_average_length']:]):.0f}%")
+                            getLogger().info(f"[{os.getpid()}] Batch cache hit rate {100 * self.recentCacheHitsSum / max(1, len(self.recentCacheHits)):.0f}%")
 
                 if self.trainingStep.numberOfIterationsCompleted % self.config['iterations_between_db_saves'] == (self.config['iterations_between_db_saves'] - 1):
                     if self.gpu is None or self.gpu == 0:
@@ -215,6 +318,7 @@ class TrainingManager:
 
             self.trainingStep.saveToDisk(self.config)
 
+            self.prefetchExecutor.shutdown(wait=True)
             self.threadExecutor.shutdown(wait=True)
 
             self.shutdownAndJoinSubProcesses()
@@ -225,10 +329,12 @@ class TrainingManager:
             success = False
             exception = traceback.format_exc()
         finally:
-            files = os.listdir(self.batchDirectory)
-            for file in files:
-                os.unlink(os.path.join(self.batchDirectory, file))
-            os.rmdir(self.batchDirectory)
+            # The sub processes are still running if the training loop failed part way through. They have to be
+            # stopped before the result queues are drained, so that no more batches get added afterwards.
+            if any(subProcess.is_alive() for subProcess in self.subProcesses):
+                self.shutdownAndJoinSubProcesses()
+            self.releaseQueuedBatches()
+            self.releaseOrphanedSharedMemory()
 
             del self.agent
 
@@ -241,12 +347,28 @@ class TrainingManager:
         return returnData
 
     def learnFromBatches(self, batches):
-        learningIterationStartTime = datetime.now()
-        results = self.agent.learnFromBatches(batches)
-        learningIterationFinishTime = datetime.now()
-        self.coreLearningTimes.append((learningIterationFinishTime - learningIterationStartTime).total_seconds())
+        if self.gpu == 0:
+            # On the GPU the learning time is measured with cuda events, which are only
+            # synchronized when the times are actually needed for the log output. Only
+            # the first GPU prints the times, so the other GPUs don't record them at all.
+            learningIterationStartEvent = torch.cuda.Event(enable_timing=True)
+            learningIterationFinishEvent = torch.cuda.Event(enable_timing=True)
+            learningIterationStartEvent.record()
+            results = self.agent.learnFromBatches(batches)
+            learningIterationFinishEvent.record()
+            self.pendingCoreLearningTimeEvents.append((learningIterationStartEvent, learningIterationFinishEvent))
+        elif self.gpu is None:
+            learningIterationStartTime = time.perf_counter()
+            results = self.agent.learnFromBatches(batches)
+            self.coreLearningTimeSum += time.perf_counter() - learningIterationStartTime
+            self.coreLearningTimeCount += 1
+        else:
+            results = self.agent.learnFromBatches(batches)
 
         if results is not None:
+            updatedTraceIds = []
+            updatedRewardLosses = []
+
             for result, batch in zip(results, batches):
                 totalRewardLoss, presentRewardLoss, discountedFutureRewardLoss, \
                 stateValueLoss, advantageLoss, actionProbabilityLoss, tracePredictionLoss, \
@@ -266,59 +388,71 @@ class TrainingManager:
                 self.trainingStep.totalRebalancedLosses.append(totalRebalancedLoss)
                 self.trainingStep.totalLosses.append(totalLoss)
 
-                for executionTraceId, sampleRewardLoss in zip(batch['traceIds'], sampleRewardLosses):
-                    for subProcessCommandQueue in self.subProcessCommandQueues:
-                        subProcessCommandQueue.put(
-                            ("update-loss", {"executionTraceId": executionTraceId, "sampleRewardLoss": sampleRewardLoss}))
+                updatedTraceIds.extend(batch['traceIds'])
+                updatedRewardLosses.extend(sampleRewardLosses)
+
+            # All of the loss updates for the iteration are sent to each sub process in a single message
+            traceIdsArray = numpy.array(updatedTraceIds, dtype=object)
+            rewardLossesArray = numpy.array(updatedRewardLosses, dtype=numpy.float32)
+            for subProcessCommandQueue in self.subProcessCommandQueues:
+                subProcessCommandQueue.put((TrainingManager.commandUpdateLossBatch, traceIdsArray, rewardLossesArray))
             return True
         else:
             self.trainingStep.hadNaN = True
             return False
 
+    def collectCoreLearningTimes(self):
+        for learningIterationStartEvent, learningIterationFinishEvent in self.pendingCoreLearningTimeEvents:
+            learningIterationFinishEvent.synchronize()
+            self.coreLearningTimeSum += learningIterationStartEvent.elapsed_time(learningIterationFinishEvent) / 1000.0
+            self.coreLearningTimeCount += 1
+        self.pendingCoreLearningTimeEvents = []
+
     def queueBatchesForPrecomputation(self):
         # First we chuck some batch requests into the queue.
         for n in range(self.config['training_precompute_batches_count']):
-            subProcessIndex = (self.batchesPrepared % self.config['training_batch_prep_subprocesses'])
-            self.batchFutures.append(
-                self.threadExecutor.submit(TrainingManager.prepareAndLoadBatch,
-                                           self.subProcessCommandQueues[subProcessIndex],
-                                           self.subProcessBatchResultQueues[subProcessIndex]))
-            self.batchesPrepared += 1
+            self.requestBatch()
+
+    def requestBatch(self):
+        subProcessIndex = (self.batchesPrepared % self.config['training_batch_prep_subprocesses'])
+        future = self.threadExecutor.submit(TrainingManager.prepareAndLoadBatch,
+                                            self.subProcessCommandQueues[subProcessIndex],
+                                            self.subProcessBatchResultQueues[subProcessIndex],
+                                            self.gpu is not None)
+        # Futures are put into the ready queue as soon as they complete, so that
+        # fetching a ready batch never has to scan through the pending ones.
+        future.add_done_callback(self.readyBatchFutures.put)
+        self.batchesPrepared += 1
 
     def createSubproccesses(self):
-        # Haven't decided yet whether we should force Kwola to always write to disc or spool in memory
-        # using /tmp. The following lines switch between the two approaches
-        # self.batchDirectory = tempfile.mkdtemp(dir=getKwolaUserDataDirectory("batches"))
-        self.batchDirectory = tempfile.mkdtemp()
-
         self.subProcessCommandQueues = []
         self.subProcessBatchResultQueues = []
         self.subProcesses = []
 
         for subprocessIndex in range(self.config['training_batch_prep_subprocesses']):
+            # The command queue has to be a full Queue rather than a SimpleQueue. Its feeder thread means that a put
+            # never blocks the training loop, even if the sub process has stalled or died and stopped reading.
             subProcessCommandQueue = multiprocessing.Queue()
             subProcessBatchResultQueue = multiprocessing.Queue()
 
-            subProcess = multiprocessing.Process(target=TrainingManager.prepareAndLoadBatchesSubprocess, args=(self.configDir, self.batchDirectory, subProcessCommandQueue, subProcessBatchResultQueue, subprocessIndex, self.applicationId))
+            subProcess = multiprocessing.Process(target=TrainingManager.prepareAndLoadBatchesSubprocess, args=(self.configDir, subProcessCommandQueue, subProcessBatchResultQueue, subprocessIndex, self.applicationId, self.sharedMemoryPrefix))
             subProcess.start()
-            atexit.register(lambda: subProcess.terminate())
+            # The bound method is registered, rather than a lambda, so that each handler refers to
+            # its own sub process, and so that it can be unregistered again on a clean shutdown.
+            atexit.register(subProcess.terminate)
 
             self.subProcessCommandQueues.append(subProcessCommandQueue)
             self.subProcessBatchResultQueues.append(subProcessBatchResultQueue)
             self.subProcesses.append(subProcess)
 
-        for queue in self.subProcessBatchResultQueues:
-            readyState = queue.get()
+        for subProcessBatchResultQueue in self.subProcessBatchResultQueues:
+            readyState = subProcessBatchResultQueue.get()
 
             if readyState == "error":
                 raise Exception("Error occurred during batch prep sub process initiation.")
 
     def countReadyBatches(self):
-        ready = 0
-        for future in self.batchFutures:
-            if future.done():
-                ready += 1
-        return ready
+        return self.readyBatchFutures.qsize()
 
 
     def updateBatchPrepStarvedState(self):
@@ -327,7 +461,7 @@ class TrainingManager:
             if ready < (self.config['training_precompute_batches_count'] / 4):
                 if not self.starved:
                     for subProcessCommandQueue in self.subProcessCommandQueues:
-                        subProcessCommandQueue.put(("starved", {}))
+                        subProcessCommandQueue.put((TrainingManager.commandStarved,))
                     self.starved = True
                     getLogger().info(
                         f"[{os.getpid()}] GPU pipeline is starved for batches. Ready batches: {ready}. Switching to starved state.")
@@ -335,43 +469,46 @@ class TrainingManager:
             else:
                 if self.starved:
                     for subProcessCommandQueue in self.subProcessCommandQueues:
-                        subProcessCommandQueue.put(("full", {}))
+                        subProcessCommandQueue.put((TrainingManager.commandFull,))
                     self.starved = False
                     getLogger().info(f"[{os.getpid()}] GPU pipeline is full of batches. Ready batches: {ready}. Switching to full state")
                     self.lastStarveStateAdjustment = self.trainingStep.numberOfIterationsCompleted
 
+    def fetchAndPrefetchBatchesForIteration(self):
+        if self.gpu is not None:
+            # The current cuda device is set separately for each thread, and this can be run on the prefetch thread
+            with torch.cuda.device(self.gpu):
+                return self.agent.prefetchBatchesToDevice(self.fetchBatchesForIteration())
+        else:
+            return self.agent.prefetchBatchesToDevice(self.fetchBatchesForIteration())
+
     def fetchBatchesForIteration(self):
         batches = []
 
         for batchIndex in range(self.config['batches_per_iteration']):
-            chosenBatchIndex = 0
-            found = False
-            for futureIndex, future in enumerate(self.batchFutures):
-                if future.done():
-                    chosenBatchIndex = futureIndex
-                    found = True
-                    break
-
-            batchFetchStartTime = datetime.now()
-            batch, cacheHitRate = self.batchFutures.pop(chosenBatchIndex).result()
-            batchFetchFinishTime = datetime.now()
-
-            fetchTime = (batchFetchFinishTime - batchFetchStartTime).total_seconds()
+            try:
+                future = self.readyBatchFutures.get_nowait()
+            except queue.Empty:
+                # The wait is only timed when we actually have to block for a batch
+                batchFetchStartTime = time.perf_counter()
+                future = self.readyBatchFutures.get()
+                fetchTime = time.perf_counter() - batchFetchStartTime
+
+                if fetchTime > 0.5:
+                    getLogger().info(
+                        f"[{os.getpid()}] I was starved waiting for a batch to be assembled. Waited: {fetchTime:.2f}")
 
-            if not found and fetchTime > 0.5:
-                getLogger().info(
-                    f"[{os.getpid()}] I was starved waiting for a batch to be assembled. Waited: {fetchTime:.2f}")
+            batch, cacheHitRate = future.result()
 
+            if len(self.recentCacheHits) == self.recentCacheHits.maxlen:
+                self.recentCacheHitsSum -= self.recentCacheHits[0]
             self.recentCacheHits.append(float(cacheHitRate))
+            self.recentCacheHitsSum += float(cacheHitRate)
             batches.append(batch)
 
             if self.batchesPrepared <= self.totalBatchesNeeded:
                 # Request another session be prepared
-                subProcessIndex = (self.batchesPrepared % self.config['training_batch_prep_subprocesses'])
-                self.batchFutures.append(self.threadExecutor.submit(TrainingManager.prepareAndLoadBatch,
-                                                                    self.subProcessCommandQueues[subProcessIndex],
-                                                                    self.subProcessBatchResultQueues[subProcessIndex]))
-                self.batchesPrepared += 1
+                self.requestBatch()
 
         return batches
 
@@ -379,7 +516,7 @@ class TrainingManager:
     def shutdownAndJoinSubProcesses(self):
         getLogger().info(f"[{os.getpid()}] Shutting down and joining the sub-processes")
         for subProcess, subProcessCommandQueue in zip(self.subProcesses, self.subProcessCommandQueues):
-            subProcessCommandQueue.put(("quit", {}))
+            subProcessCommandQueue.put((TrainingManager.commandQuit,))
             subProcess.join(timeout=30)
             if subProcess.is_alive():
                 # Use kill in python 3.7+, terminate in lower versions
@@ -387,6 +524,37 @@ class TrainingManager:
                     subProcess.kill()
                 else:
                     subProcess.terminate()
+            # Nothing will read any commands still buffered for a sub process that didn't
+            # exit cleanly, so this process shouldn't wait to flush them when it exits.
+            if subProcess.exitcode != 0:
+                subProcessCommandQueue.cancel_join_thread()
+            atexit.unregister(subProcess.terminate)
+
+    def releaseQueuedBatches(self):
+        # Any surplus batches that were never fetched still own their shared memory segments, which
+        # would otherwise outlive this process.
+        for subProcessBatchResultQueue in self.subProcessBatchResultQueues:
+            while True:
+                try:
+                    sharedBatch, cacheHit = subProcessBatchResultQueue.get_nowait()
+                except queue.Empty:
+                    break
+                TrainingManager.releaseSharedSample(sharedBatch)
+
+    def releaseOrphanedSharedMemory(self):
+        # Segments that were still being handed between processes when the sub processes stopped will never be loaded
+        # by anyone. All of them are named with this trainer's prefix, so they can be found and removed directly.
+        try:
+            entries = list(os.scandir(TrainingManager.sharedMemoryDirectory))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry.name.startswith(self.sharedMemoryPrefix):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
 
     def saveAgent(self):
         # Safe guard, don't save the model if any nan's were detected
@@ -402,43 +570,148 @@ class TrainingManager:
 
     @staticmethod
     def saveExecutionTraceWeightData(traceWeightData, configDir):
-        config = KwolaCoreConfiguration(configDir)
+        config = TrainingManager.getWorkerConfig(configDir)
+
+        weightFile = os.path.join(config.getKwolaUserDataDirectory("execution_trace_weight_files"), traceWeightData['id'] + "-weight.bin")
+
+        # The weight is stored as a single little endian double
+        with open(weightFile, "wb") as f:
+            f.write(struct.pack("<d", traceWeightData['weight']))
+
+    @staticmethod
+    def saveExecutionTraceWeightDataWorker(traceWeightSaveQueue, configDir):
+        """
+            This is the main loop for the background processes that save trace weights. It saves each trace weight data
+            received on the queue, until it receives None.
+        """
+        TrainingManager.initializeWorker(configDir)
+
+        while True:
+            traceWeightData = traceWeightSaveQueue.get()
+            if traceWeightData is None:
+                break
+
+            try:
+                TrainingManager.saveExecutionTraceWeightData(traceWeightData, configDir)
+            except Exception:
+                getLogger().error(f"[{os.getpid()}] Error occurred while saving execution trace weight data. {traceback.format_exc()}")
+
+    @staticmethod
+    def writeSampleCacheFile(traceBatch, cacheFile):
+        """
+            Writes a single sample into the sample cache using a flat binary layout, so that it can later be
+            loaded with TrainingManager.readSampleCacheFile without any decompression or unpickling.
+
+            The file starts with an 8 byte little-endian header length, followed by a JSON header describing
+            the name, dtype, shape and offset of every numpy array in the sample. The raw array buffers follow
+            the header, each one aligned to TrainingManager.sampleCacheAlignment bytes. Any values in the sample
+            which are not numpy arrays (such as the trace ids) are stored directly in the header.
+
+            :param traceBatch: A sample dictionary, as produced by DeepLearningAgent.prepareBatchesForExecutionSession
+            :param cacheFile: The path of the file to write
+        """
+        alignment = TrainingManager.sampleCacheAlignment
+
+        arrays = []
+        values = {}
+        arrayEntries = []
+        currentOffset = 0
+        for key, value in traceBatch.items():
+            if isNumpyArray(value):
+                array = numpy.ascontiguousarray(value)
+                arrays.append((currentOffset, array))
+                arrayEntries.append({"name": key, "dtype": array.dtype.str, "shape": list(array.shape), "offset": currentOffset})
+                currentOffset += array.nbytes
+                currentOffset += (-currentOffset) % alignment
+            else:
+                values[key] = value
+
+        headerBytes = json.dumps({"arrays": arrayEntries, "values": values}).encode("utf8")
+        dataStart = TrainingManager.sampleCacheDataStart(len(headerBytes))
+
+        if len(arrays) > 0:
+            lastOffset, lastArray = arrays[-1]
+            totalSize = dataStart + lastOffset + lastArray.nbytes
+        else:
+            totalSize = dataStart
 
-        weightFile = os.path.join(config.getKwolaUserDataDirectory("execution_trace_weight_files"), traceWeightData['id'] + "-weight.json")
+        # Other workers may have the existing cache file memory mapped, so it is never modified in place. The sample is
+        # written to a temporary file in the same directory, which then atomically replaces the old file.
+        fileDescriptor, temporaryFile = tempfile.mkstemp(dir=os.path.dirname(cacheFile), suffix=".tmp")
+        try:
+            with open(fileDescriptor, 'wb') as file:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(file.fileno(), 0, totalSize)
 
-        saveData = {"weight": traceWeightData['weight']}
+                file.write(struct.pack("<Q", len(headerBytes)))
+                file.write(headerBytes)
 
-        with open(weightFile, "wt") as f:
-            json.dump(saveData, f)
+                for offset, array in arrays:
+                    file.seek(dataStart + offset)
+                    array.tofile(file)
+
+            os.replace(temporaryFile, cacheFile)
+        except BaseException:
+            if os.path.exists(temporaryFile):
+                os.unlink(temporaryFile)
+            raise
+
+    @staticmethod
+    def readSampleCacheFile(cacheFile):
+        """
+            Loads a sample that was written with TrainingManager.writeSampleCacheFile. The numpy arrays in the
+            returned dictionary are read-only views directly onto a memory map of the file, so no data is
+            copied until the arrays are actually used.
+
+            :param cacheFile: The path of the file to read
+            :return: A sample dictionary, in the same format that was originally written.
+        """
+        memoryMap = numpy.memmap(cacheFile, dtype=numpy.uint8, mode='r')
+
+        headerLength = struct.unpack("<Q", memoryMap[:8].tobytes())[0]
+        header = json.loads(memoryMap[8:8 + headerLength].tobytes().decode("utf8"))
+        dataStart = TrainingManager.sampleCacheDataStart(headerLength)
+
+        sampleBatch = dict(header['values'])
+        for entry in header['arrays']:
+            shape = tuple(entry['shape'])
+            sampleBatch[entry['name']] = numpy.frombuffer(memoryMap,
+                                                          dtype=numpy.dtype(entry['dtype']),
+                                                          count=int(numpy.prod(shape)),
+                                                          offset=dataStart + entry['offset']).reshape(shape)
+
+        return sampleBatch
+
+    @staticmethod
+    def sampleCacheDataStart(headerLength):
+        dataStart = 8 + headerLength
+        return dataStart + (-dataStart) % TrainingManager.sampleCacheAlignment
 
     @staticmethod
     def writeSingleExecutionTrace(traceBatch, sampleCacheDir):
         traceId = traceBatch['traceIds'][0]
 
-        cacheFile = os.path.join(sampleCacheDir, traceId + "-sample.pickle.gz")
-
-        pickleBytes = pickle.dumps(traceBatch)
-        compressedPickleBytes = gzip.compress(pickleBytes)
+        cacheFile = os.path.join(sampleCacheDir, traceId + "-sample.bin")
 
         # getLogger().info(f"Writing batch cache file {cacheFile}")
         maxAttempts = 10
         for attempt in range(maxAttempts):
             try:
-                with open(cacheFile, 'wb') as file:
-                    file.write(compressedPickleBytes)
+                TrainingManager.writeSampleCacheFile(traceBatch, cacheFile)
                 return
             except OSError:
                 time.sleep(1.5 ** attempt)
                 continue
 
     @staticmethod
-    def addExecutionSessionToSampleCache(executionSessionId, config):
+    def addExecutionSessionToSampleCache(executionSessionId, config, agent=None):
         getLogger().info(f"Adding {executionSessionId} to the sample cache.")
         config.connectToMongoIfNeeded()
         maxAttempts = 10
         for attempt in range(maxAttempts):
             try:
-                agent = DeepLearningAgent(config, whichGpu=None)
+                if agent is None:
+                    agent = DeepLearningAgent(config, whichGpu=None)
 
                 sampleCacheDir = config.getKwolaUserDataDirectory("prepared_samples")
 
@@ -446,12 +719,14 @@ class TrainingManager:
 
                 batches = agent.prepareBatchesForExecutionSession(executionSession)
 
-                with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-                    futures = []
-                    for traceIndex, traceBatch in zip(range(len(executionSession.executionTraces) - 1), batches):
-                        futures.append(executor.submit(TrainingManager.writeSingleExecutionTrace, traceBatch, sampleCacheDir))
-                    for future in futures:
-                        future.result()
+                traceBatches = [traceBatch for traceIndex, traceBatch in zip(range(len(executionSession.executionTraces) - 1), batches)]
+
+                # Threads are sufficient here because the sample cache files are written as raw array
+                # buffers, and numpy releases the GIL while writing them out.
+                writerCount = max(1, min(os.cpu_count() or 1, len(traceBatches)))
+                with concurrent.futures.ThreadPoolExecutor(max_workers=writerCount) as executor:
+                    for result in executor.map(TrainingManager.writeSingleExecutionTrace, traceBatches, [sampleCacheDir] * len(traceBatches)):
+                        pass
                 getLogger().info(f"Finished adding {executionSessionId} to the sample cache.")
                 break
             except Exception as e:
@@ -462,46 +737,218 @@ class TrainingManager:
                     getLogger().warning(f"[{os.getpid()}] Warning! Failed to prepare samples for execution session {executionSessionId}. Error was: {traceback.print_exc()}")
 
     @staticmethod
-    def prepareBatchesForExecutionTrace(configDir, executionTraceId, executionSessionId, batchDirectory, applicationId):
+    def moveSampleToSharedMemory(sample, namePrefix=None):
+        """
+            Copies all of the numpy arrays in a sample into newly created shared memory segments, so that the sample
+            can be handed to another process without pickling or writing the array data to disk. Ownership of the
+            segments passes to whichever process calls TrainingManager.loadSampleFromSharedMemory.
+
+            Shared memory lives in TrainingManager.sharedMemoryDirectory, which is only 64mb by default inside docker
+            containers. Writing past the end of it kills the process with SIGBUS rather than raising an error, so the
+            space for each segment is reserved before anything is written. If there isn't enough space, the arrays
+            are left in the returned dictionary instead, and get pickled along with it.
+
+            :param sample: A dictionary containing numpy arrays and other plain values
+            :param namePrefix: An optional prefix for the names of the shared memory segments. This lets
+                               TrainingManager.releaseOrphanedSharedMemory find segments that were never loaded.
+            :return: A small dictionary describing the sample, containing the shared memory segment name, shape
+                     and dtype for each array along with all of the non-array values.
+        """
+        arrayBytes = sum(value.nbytes for value in sample.values() if isNumpyArray(value))
+        if not TrainingManager.hasSharedMemorySpace(arrayBytes):
+            return {"arrays": {}, "values": dict(sample)}
+
+        sharedArrays = {}
+        values = {}
+        segments = []
         try:
-            config = KwolaCoreConfiguration(configDir)
+            for key, value in sample.items():
+                if isNumpyArray(value):
+                    name = None
+                    if namePrefix is not None:
+                        name = namePrefix + secrets.token_hex(8)
+                    segment = shared_memory.SharedMemory(name=name, create=True, size=max(1, value.nbytes))
+                    segments.append(segment)
+                    TrainingManager.reserveSharedMemory(segment)
+                    numpy.ndarray(value.shape, dtype=value.dtype, buffer=segment.buf)[...] = value
+                    sharedArrays[key] = (segment.name, value.shape, value.dtype.str)
+                else:
+                    values[key] = value
+        except OSError:
+            # The shared memory ran out after all, since other processes are allocating it at the same
+            # time. This sample is sent with its arrays pickled instead.
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+            return {"arrays": {}, "values": dict(sample)}
+        except Exception:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+            raise
 
-            agent = DeepLearningAgent(config, whichGpu=None)
+        for segment in segments:
+            # The receiving process is responsible for unlinking the segment, so we stop
+            # this process's resource tracker from also trying to clean it up at exit.
+            # The tracker knows the segment by its name with the leading slash.
+            resource_tracker.unregister("/" + segment.name, "shared_memory")
+            segment.close()
+
+        return {"arrays": sharedArrays, "values": values}
+
+    @staticmethod
+    def hasSharedMemorySpace(byteCount):
+        try:
+            stats = os.statvfs(TrainingManager.sharedMemoryDirectory)
+        except (AttributeError, OSError):
+            # Shared memory isn't backed by a size limited file system on this platform
+            return True
+
+        return stats.f_bavail * stats.f_frsize >= byteCount
+
+    @staticmethod
+    def reserveSharedMemory(segment):
+        # Allocating all of the pages up front means that running out of shared memory raises an
+        # OSError here, rather than a SIGBUS when the array gets copied into the segment.
+        segmentPath = os.path.join(TrainingManager.sharedMemoryDirectory, segment.name)
+        if hasattr(os, 'posix_fallocate') and os.path.exists(segmentPath):
+            fileDescriptor = os.open(segmentPath, os.O_RDWR)
+            try:
+                os.posix_fallocate(fileDescriptor, 0, segment.size)
+            finally:
+                os.close(fileDescriptor)
+
+    @staticmethod
+    def loadSampleFromSharedMemory(sharedSample):
+        """
+            Loads a sample that was created with TrainingManager.moveSampleToSharedMemory. The arrays are copied
+            out of shared memory and the shared memory segments are then released.
+
+            :param sharedSample: The dictionary returned by TrainingManager.moveSampleToSharedMemory
+            :return: The original sample dictionary
+        """
+        sample = dict(sharedSample['values'])
+        arrayItems = list(sharedSample['arrays'].items())
+        for itemIndex, (key, (name, shape, dtype)) in enumerate(arrayItems):
+            try:
+                segment = shared_memory.SharedMemory(name=name)
+                try:
+                    sample[key] = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=segment.buf).copy()
+                finally:
+                    segment.close()
+                    segment.unlink()
+            except Exception:
+                # The rest of the segments still have to be released, even though the sample can't be loaded
+                TrainingManager.releaseSharedSample({"arrays": dict(arrayItems[itemIndex + 1:]), "values": {}})
+                raise
+        return sample
+
+    @staticmethod
+    def releaseSharedSample(sharedSample):
+        """
+            Releases the shared memory segments of a sample that was created with TrainingManager.moveSampleToSharedMemory,
+            without loading it. This is used for samples that will never be loaded, so their segments don't leak.
+
+            :param sharedSample: The dictionary returned by TrainingManager.moveSampleToSharedMemory
+        """
+        for name, shape, dtype in sharedSample['arrays'].values():
+            try:
+                segment = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                continue
+            segment.close()
+            segment.unlink()
+
+    @staticmethod
+    def getWorkerConfig(configDir):
+        """
+            Returns the configuration object for the given config directory, creating it only the first time it is
+            needed in this process. This saves re-reading the configuration from disk for every task run in a worker.
+        """
+        if workerProcessState.get('configDir') != configDir or 'config' not in workerProcessState:
+            workerProcessState['configDir'] = configDir
+            workerProcessState['config'] = KwolaCoreConfiguration(configDir)
+        return workerProcessState['config']
+
+    @staticmethod
+    def initializeWorker(configDir):
+        """
+            This is the initializer for the worker processes that load and save the trace data. It sets up logging and
+            creates the configuration object once, so it doesn't need to be rebuilt for every task.
+        """
+        setupLocalLogging()
+        TrainingManager.getWorkerConfig(configDir)
+
+    @staticmethod
+    def initializeBatchPrepWorker(configDir, applicationId, sharedMemoryPrefix=None):
+        """
+            This is the initializer for the batch preparation worker processes. It stores the arguments that are shared
+            by every task in the worker, so that they only have to be sent once when the worker starts. It also creates
+            the configuration and agent objects once, so they don't need to be rebuilt for every task.
+        """
+        TrainingManager.initializeWorker(configDir)
+        workerProcessState['applicationId'] = applicationId
+        workerProcessState['sharedMemoryPrefix'] = sharedMemoryPrefix
+        workerProcessState['agent'] = DeepLearningAgent(workerProcessState['config'], whichGpu=None)
+        workerProcessState['rng'] = numpy.random.default_rng()
+
+    @staticmethod
+    def prepareBatchesForExecutionTrace(executionTraceId, executionSessionId):
+        try:
+            config = workerProcessState['config']
+            agent = workerProcessState['agent']
+            rng = workerProcessState['rng']
 
             sampleCacheDir = config.getKwolaUserDataDirectory("prepared_samples", ensureExists=False)
-            cacheFile = os.path.join(sampleCacheDir, executionTraceId + "-sample.pickle.gz")
+            cacheFile = os.path.join(sampleCacheDir, executionTraceId + "-sample.bin")
 
-            # Just for compatibility with the old naming scheme
-            oldCacheFileName = os.path.join(sampleCacheDir, executionTraceId + ".pickle.gz")
+            # Just for compatibility with the old pickled cache files
+            oldCacheFileNames = [
+                os.path.join(sampleCacheDir, executionTraceId + "-sample.pickle.gz"),
+                os.path.join(sampleCacheDir, executionTraceId + ".pickle.gz")
+            ]
 
             # applicationStorageBucket = storage.Bucket(storageClient, "kwola-testing-run-data-" + applicationId + "-cache")
             # blob = storage.Blob(os.path.join(executionTraceId + "-sample.pickle.gz"), applicationStorageBucket)
 
+            sampleBatch = None
+            cacheHit = True
             try:
-                with open(cacheFile, 'rb') as file:
-                    sampleBatch = pickle.loads(gzip.decompress(file.read()))
-                # sampleBatch = pickle.loads(gzip.decompress(blob.download_as_string()))
-                cacheHit = True
+                sampleBatch = TrainingManager.readSampleCacheFile(cacheFile)
             except FileNotFoundError:
-                try:
-                    with open(oldCacheFileName, 'rb') as file:
-                        sampleBatch = pickle.loads(gzip.decompress(file.read()))
-                    # sampleBatch = pickle.loads(gzip.decompress(blob.download_as_string()))
-                    cacheHit = True
-                except FileNotFoundError:
-                    TrainingManager.addExecutionSessionToSampleCache(executionSessionId, config)
-                    cacheHit = False
-                    with open(cacheFile, 'rb') as file:
-                        sampleBatch = pickle.loads(gzip.decompress(file.read()))
+                for oldCacheFileName in oldCacheFileNames:
+                    try:
+                        with open(oldCacheFileName, 'rb') as file:
+                            sampleBatch = pickle.loads(gzip.decompress(file.read()))
+                        # sampleBatch = pickle.loads(gzip.decompress(blob.download_as_string()))
+                    except FileNotFoundError:
+                        continue
+
+                    # Convert the old compressed file into the new uncompressed format, so
+                    # that we only have to pay for the decompression a single time
+                    TrainingManager.writeSingleExecutionTrace(sampleBatch, sampleCacheDir)
+                    try:
+                        os.unlink(oldCacheFileName)
+                    except FileNotFoundError:
+                        pass
+                    break
+
+            if sampleBatch is None:
+                TrainingManager.addExecutionSessionToSampleCache(executionSessionId, config, agent)
+                cacheHit = False
+                sampleBatch = TrainingManager.readSampleCacheFile(cacheFile)
 
             imageWidth = sampleBatch['processedImages'].shape[3]
             imageHeight = sampleBatch['processedImages'].shape[2]
 
-            # Calculate the crop positions for the main training image
+            # Calculate the crop positions for the main training image. The random values for each crop are
+            # drawn in a single call, and only when that crop is enabled. The bounds are inclusive.
             if config['training_enable_image_cropping']:
-                randomXDisplacement = random.randint(-config['training_crop_center_random_x_displacement'], config['training_crop_center_random_x_displacement'])
-                randomYDisplacement = random.randint(-config['training_crop_center_random_y_displacement'], config['training_crop_center_random_y_displacement'])
-
+                randomXDisplacement, randomYDisplacement = rng.integers(
+                    [-config['training_crop_center_random_x_displacement'], -config['training_crop_center_random_y_displacement']],
+                    [config['training_crop_center_random_x_displacement'], config['training_crop_center_random_y_displacement']],
+                    endpoint=True
+                ).tolist()
                 cropLeft, cropTop, cropRight, cropBottom = agent.calculateTrainingCropPosition(sampleBatch['actionXs'][0] + randomXDisplacement, sampleBatch['actionYs'][0] + randomYDisplacement, imageWidth, imageHeight)
             else:
                 cropLeft = 0
@@ -511,9 +958,7 @@ class TrainingManager:
 
             # Calculate the crop positions for the next state image
             if config['training_enable_next_state_image_cropping']:
-                nextStateCropCenterX = random.randint(10, imageWidth - 10)
-                nextStateCropCenterY = random.randint(10, imageHeight - 10)
-
+                nextStateCropCenterX, nextStateCropCenterY = rng.integers([10, 10], [imageWidth - 10, imageHeight - 10], endpoint=True).tolist()
                 nextStateCropLeft, nextStateCropTop, nextStateCropRight, nextStateCropBottom = agent.calculateTrainingCropPosition(nextStateCropCenterX, nextStateCropCenterY, imageWidth, imageHeight, nextStepCrop=True)
             else:
                 nextStateCropLeft = 0
@@ -525,7 +970,6 @@ class TrainingManager:
             # This is done at this step because the cropping is random
             # and thus you don't want to store the randomly cropped version
             # in the redis cache
-            sampleBatch['processedImages'] = sampleBatch['processedImages'][:, :, cropTop:cropBottom, cropLeft:cropRight]
             sampleBatch['pixelActionMaps'] = sampleBatch['pixelActionMaps'][:, :, cropTop:cropBottom, cropLeft:cropRight]
             sampleBatch['rewardPixelMasks'] = sampleBatch['rewardPixelMasks'][:, cropTop:cropBottom, cropLeft:cropRight]
             sampleBatch['actionXs'] = sampleBatch['actionXs'] - cropLeft
@@ -538,102 +982,157 @@ class TrainingManager:
             # so that we don't store the augmented version in the redis cache.
             # Instead, we want the pure version in the redis cache and create a
             # new augmentation every time we load it.
-            processedImage = sampleBatch['processedImages'][0]
-            augmentedImage = agent.augmentProcessedImageForTraining(processedImage)
-            sampleBatch['processedImages'][0] = augmentedImage
-
-            fileDescriptor, fileName = tempfile.mkstemp(".bin", dir=batchDirectory)
-
-            with open(fileDescriptor, 'wb') as batchFile:
-                pickle.dump(sampleBatch, batchFile)
-
-            return fileName, cacheHit
+            # The crop is copied into a float32 buffer that is reused for every sample
+            # processed by this worker, since numba is unable to operate on float16 arrays.
+            croppedImage = sampleBatch['processedImages'][0, :, cropTop:cropBottom, cropLeft:cropRight]
+            augmentationBuffer = getAugmentationBuffer(croppedImage.shape)
+            numpy.copyto(augmentationBuffer, croppedImage)
+            augmentProcessedImageKernel(augmentationBuffer, float(config['training_image_gaussian_noise_scale']))
+            sampleBatch['processedImages'] = augmentationBuffer[numpy.newaxis].astype(sampleBatch['processedImages'].dtype)
+
+            return TrainingManager.moveSampleToSharedMemory(sampleBatch, workerProcessState['sharedMemoryPrefix']), cacheHit
         except Exception:
+            # The error is returned rather than raised. If it were raised, the whole batch would fail and the
+            # shared memory for the other samples in the batch would never be released.
             getLogger().critical(traceback.format_exc())
-            raise
+            return None, False
 
     @staticmethod
-    def prepareAndLoadSingleBatchForSubprocess(config, executionTraceWeightDatas, executionTraceWeightDataIdMap, batchDirectory, cacheFullState, processPool, subProcessCommandQueue, subProcessBatchResultQueue, applicationId):
-        try:
-            traceWeights = numpy.array([traceWeightData['weight'] for traceWeightData in executionTraceWeightDatas])
+    def concatenateWithOffsets(samples, keys):
+        """
+            Concatenates the variable length arrays stored under each of the given keys in the samples into
+            preallocated arrays, and computes the offset at which each sample's data starts. All of the keys
+            must hold parallel arrays of the same length within each sample, so they share one set of offsets
+            and are all filled in a single pass over the samples.
+
+            :param samples: A list of sample dictionaries, each holding a single row under each key
+            :param keys: The keys of the parallel arrays to concatenate
+            :return: A tuple containing a dictionary of the concatenated arrays and the offsets array
+        """
+        lengths = numpy.fromiter((len(sample[keys[0]][0]) for sample in samples), dtype=numpy.int64, count=len(samples))
+
+        offsets = numpy.zeros([len(samples)], dtype=numpy.int64)
+        numpy.cumsum(lengths[:-1], out=offsets[1:])
+
+        totalLength = int(lengths.sum())
+        concatenated = {
+            key: numpy.empty((totalLength,) + samples[0][key][0].shape[1:], dtype=samples[0][key][0].dtype)
+            for key in keys
+        }
+        for sample, offset, length in zip(samples, offsets.tolist(), lengths.tolist()):
+            for key in keys:
+                concatenated[key][offset:offset + length] = sample[key][0]
+
+        return concatenated, offsets
 
-            traceWeights = numpy.minimum(config['training_trace_selection_maximum_weight'], traceWeights)
-            traceWeights = numpy.maximum(config['training_trace_selection_minimum_weight'], traceWeights)
-
-            if not cacheFullState:
-                # We bias the random selection of the algorithm towards whatever
-                # is at the one end of the list when we aren't in cache full state.
-                # This just gives a bit of bias towards the algorithm to select
-                # the same execution traces while the system is booting up
-                # and gets the GPU to full speed sooner without requiring the cache to be
-                # completely filled. This is helpful when cold starting a training run, such
-                # as when doing R&D. it basically plays no role once you have a run going
-                # for any length of time since the batch cache will fill up within
-                # a single training step.
-                traceWeights = traceWeights + numpy.arange(0, config['training_trace_selection_cache_not_full_state_one_side_bias'], len(traceWeights))
-
-            traceProbabilities = scipy.special.softmax(traceWeights)
-            traceIds = [trace['id'] for trace in executionTraceWeightDatas]
-
-            chosenExecutionTraceIds = numpy.random.choice(traceIds, [config['batch_size']], p=traceProbabilities)
-
-            futures = []
-            for traceId in chosenExecutionTraceIds:
-                traceWeightData = executionTraceWeightDataIdMap[str(traceId)]
+    @staticmethod
+    def computeTraceSelectionCdf(config, executionTraceWeights, cacheFullState):
+        """
+            Computes the cumulative distribution used to randomly select execution traces for batches. Each trace is
+            selected with the softmax probability of its selection logit. The distribution is left unnormalized, so
+            draws should be scaled by its last value.
+
+            :param config: The training config
+            :param executionTraceWeights: A float64 numpy array containing the weight for each execution trace
+            :param cacheFullState: Whether the batch cache is currently considered to be full
+            :return: A float64 numpy array of the same length as executionTraceWeights
+        """
+        oneSideBias = 0.0
+        if not cacheFullState:
+            # We bias the random selection of the algorithm towards whatever
+            # is at the one end of the list when we aren't in cache full state.
+            # This just gives a bit of bias towards the algorithm to select
+            # the same execution traces while the system is booting up
+            # and gets the GPU to full speed sooner without requiring the cache to be
+            # completely filled. This is helpful when cold starting a training run, such
+            # as when doing R&D. it basically plays no role once you have a run going
+            # for any length of time since the batch cache will fill up within
+            # a single training step.
+            oneSideBias = float(config['training_trace_selection_cache_not_full_state_one_side_bias'])
+
+        traceLogits = numpy.empty_like(executionTraceWeights)
+        computeTraceSelectionLogits(executionTraceWeights,
+                                    float(config['training_trace_selection_minimum_weight']),
+                                    float(config['training_trace_selection_maximum_weight']),
+                                    oneSideBias,
+                                    traceLogits)
+
+        return numpy.cumsum(numpy.exp(traceLogits - traceLogits.max()))
 
-                future = processPool.apply_async(TrainingManager.prepareBatchesForExecutionTrace, (config.configurationDirectory, str(traceId), str(traceWeightData['executionSessionId']), batchDirectory, applicationId))
-                futures.append(future)
+    @staticmethod
+    def prepareAndLoadSingleBatchForSubprocess(config, executionTraceWeightDatas, traceSelectionCdf, processPool, subProcessCommandQueue, subProcessBatchResultQueue, sharedMemoryPrefix=None):
+        try:
+            rng = numpy.random.default_rng()
+            chosenTraceIndexes = numpy.searchsorted(traceSelectionCdf, rng.random(config['batch_size']) * traceSelectionCdf[-1], side='right')
+            chosenTraceIndexes = numpy.minimum(chosenTraceIndexes, len(traceSelectionCdf) - 1)
+
+            traceArguments = []
+            for traceIndex in chosenTraceIndexes:
+                traceWeightData = executionTraceWeightDatas[traceIndex]
+                traceArguments.append((str(traceWeightData['id']), str(traceWeightData['executionSessionId'])))
+
+            # Each sample is submitted to the process pool as its own task, which is what the batch prep pools count
+            # when deciding how often to recycle their workers.
+            sampleFutures = [processPool.apply_async(TrainingManager.prepareBatchesForExecutionTrace, arguments) for arguments in traceArguments]
+
+            # Every result is collected even when some of the tasks fail, such as when a worker process dies,
+            # so that the shared memory of the samples that did succeed can still be released.
+            results = []
+            for sampleFuture in sampleFutures:
+                try:
+                    results.append(sampleFuture.get())
+                except Exception:
+                    getLogger().error(f"[{os.getpid()}] A batch prep worker failed while preparing a sample.\n{traceback.format_exc()}")
+                    results.append((None, False))
+            cacheHits = [float(cacheHit) for sharedSample, cacheHit in results]
+            pendingSharedSamples = collections.deque(sharedSample for sharedSample, cacheHit in results if sharedSample is not None)
 
-            cacheHits = []
             samples = []
-            for future in futures:
-                batchFilename, cacheHit = future.get()
-                cacheHits.append(float(cacheHit))
-
-                with open(batchFilename, 'rb') as batchFile:
-                    sampleBatch = pickle.load(batchFile)
-                    samples.append(sampleBatch)
+            try:
+                if len(pendingSharedSamples) < len(results):
+                    raise RuntimeError(f"Failed to prepare {len(results) - len(pendingSharedSamples)} of the execution traces for the batch.")
 
-                os.unlink(batchFilename)
+                while len(pendingSharedSamples) > 0:
+                    samples.append(TrainingManager.loadSampleFromSharedMemory(pendingSharedSamples.popleft()))
+            except Exception:
+                # The samples which were prepared successfully still own their shared memory
+                for sharedSample in pendingSharedSamples:
+                    TrainingManager.releaseSharedSample(sharedSample)
+                raise
 
             batch = {}
+
+            # The symbol arrays have a different length in every sample, so they have to be concatenated together
+            # with offsets rather than stacked. The indexes and weights in each family share the same offsets.
+            symbolKeys = set()
+            for offsetsKey, familyKeys in TrainingManager.symbolKeyFamilies.items():
+                if familyKeys[0] in samples[0]:
+                    concatenated, batch[offsetsKey] = TrainingManager.concatenateWithOffsets(samples, familyKeys)
+                    batch.update(concatenated)
+                    symbolKeys.update(familyKeys)
+
             for key in samples[0].keys():
-                # We have to do something special here since they are not concatenated the normal way
-                if key == "symbolIndexes" or key == 'symbolWeights' \
-                        or key == "nextSymbolIndexes" or key == 'nextSymbolWeights' \
-                        or key == "decayingFutureSymbolIndexes" or key == 'decayingFutureSymbolWeights':
-                    batch[key] = numpy.concatenate([sample[key][0] for sample in samples], axis=0)
-
-                    currentOffset = 0
-                    offsets = []
-                    for sample in samples:
-                        offsets.append(currentOffset)
-                        currentOffset += len(sample[key][0])
-
-                    if 'next' in key:
-                        batch['nextSymbolOffsets'] = numpy.array(offsets)
-                    elif 'decaying' in key:
-                        batch['decayingFutureSymbolOffsets'] = numpy.array(offsets)
-                    else:
-                        batch['symbolOffsets'] = numpy.array(offsets)
+                if key in symbolKeys:
+                    continue
+
+                if isNumpyArray(samples[0][key]):
+                    # Each sample holds a single row, so the batch array is allocated once
+                    # and each sample is copied directly into its row.
+                    batch[key] = numpy.empty((len(samples),) + samples[0][key].shape[1:], dtype=samples[0][key].dtype)
+                    for sampleIndex, sample in enumerate(samples):
+                        batch[key][sampleIndex] = sample[key][0]
                 else:
-                    if isNumpyArray(samples[0][key]):
-                        batch[key] = numpy.concatenate([sample[key] for sample in samples], axis=0)
-                    else:
-                        batch[key] = [sample[key][0] for sample in samples]
+                    batch[key] = [sample[key][0] for sample in samples]
 
             cacheHitRate = numpy.mean(cacheHits)
 
-            resultFileDescriptor, resultFileName = tempfile.mkstemp()
-            with open(resultFileDescriptor, 'wb') as file:
-                pickle.dump((batch, cacheHitRate), file)
-
-            subProcessBatchResultQueue.put(resultFileName)
+            # Only the shared memory segment names and the small non-array values go through the queue
+            subProcessBatchResultQueue.put((TrainingManager.moveSampleToSharedMemory(batch, sharedMemoryPrefix), cacheHitRate))
 
             return cacheHitRate
         except Exception:
             getLogger().error(f"prepareAndLoadSingleBatchForSubprocess failed! Putting a retry into the queue.\n{traceback.format_exc()}")
-            subProcessCommandQueue.put(("batch", {}))
+            subProcessCommandQueue.put((TrainingManager.commandBatch,))
             return 1.0
 
     @staticmethod
@@ -643,28 +1142,27 @@ class TrainingManager:
         if config['data_serialization_method'] == 'mongo':
             return list(TestingStep.objects(applicationId=applicationId).no_dereference())
         else:
-            testingSteps = []
-
-            for fileName in os.listdir(testStepsDir):
-                if ".lock" not in fileName:
-                    stepId = fileName
-                    stepId = stepId.replace(".json", "")
-                    stepId = stepId.replace(".gz", "")
-                    stepId = stepId.replace(".pickle", "")
+            stepIds = [
+                TrainingManager.dataFileExtensionRegex.sub("", entry.name, count=1)
+                for entry in os.scandir(testStepsDir)
+                if not entry.name.endswith(".lock")
+            ]
 
-                    testingSteps.append(TestingStep.loadFromDisk(stepId, config))
+            # Loading the steps is mostly waiting on the disk, so it is spread across threads
+            with concurrent.futures.ThreadPoolExecutor(max_workers=config['training_max_initialization_workers']) as executor:
+                testingSteps = list(executor.map(lambda stepId: TestingStep.loadFromDisk(stepId, config), stepIds))
 
             return testingSteps
 
     @staticmethod
     def updateTraceRewardLoss(traceId, sampleRewardLoss, configDir):
-        config = KwolaCoreConfiguration(configDir)
+        config = TrainingManager.getWorkerConfig(configDir)
         trace = ExecutionTrace.loadFromDisk(traceId, config, omitLargeFields=False)
         trace.lastTrainingRewardLoss = sampleRewardLoss
         trace.saveToDisk(config)
 
     @staticmethod
-    def prepareAndLoadBatchesSubprocess(configDir, batchDirectory, subProcessCommandQueue, subProcessBatchResultQueue, subprocessIndex=0, applicationId=None):
+    def prepareAndLoadBatchesSubprocess(configDir, subProcessCommandQueue, subProcessBatchResultQueue, subprocessIndex=0, applicationId=None, sharedMemoryPrefix=None):
         try:
             setupLocalLogging()
 
@@ -682,17 +1180,18 @@ class TrainingManager:
             else:
                 getLogger().info(f"[{os.getpid()}] Found {len(testingSteps)} total testing steps for this application.")
 
+            initialDataLoadProcessPool = multiprocessingpool.Pool(processes=int(config['training_max_initialization_workers'] / config['training_batch_prep_subprocesses']), initializer=TrainingManager.initializeWorker, initargs=(configDir,))
+
             # We use this mechanism to force parallel preloading of all the execution traces. Otherwise it just takes forever...
+            # The sessions are loaded in the same process pool as the weight datas, since parsing them is CPU bound. They are
+            # kept in order, because the selection bias used while the cache is filling up depends on the order of the traces.
             executionSessionIds = []
-            with concurrent.futures.ThreadPoolExecutor(max_workers=int(config['training_max_initialization_workers'] / config['training_batch_prep_subprocesses'])) as executor:
-                executionSessionFutures = []
-                for testStepIndex, testStep in enumerate(testingSteps):
-                    if testStepIndex % config['training_batch_prep_subprocesses'] == subprocessIndex:
-                        for sessionId in testStep.executionSessions:
-                            executionSessionIds.append(str(sessionId))
-                            executionSessionFutures.append(executor.submit(TrainingManager.loadExecutionSession, sessionId, config))
+            for testStepIndex, testStep in enumerate(testingSteps):
+                if testStepIndex % config['training_batch_prep_subprocesses'] == subprocessIndex:
+                    for sessionId in testStep.executionSessions:
+                        executionSessionIds.append(str(sessionId))
 
-                executionSessions = [future.result() for future in executionSessionFutures]
+            executionSessions = list(initialDataLoadProcessPool.imap(TrainingManager.loadExecutionSessionInWorker, executionSessionIds, chunksize=16))
 
             getLogger().info(f"[{os.getpid()}] Found {len(executionSessionIds)} total execution sessions that can be learned.")
 
@@ -701,20 +1200,17 @@ class TrainingManager:
             executionTraceWeightDatas = []
             executionTraceWeightDataIdMap = {}
 
-            initialDataLoadProcessPool = multiprocessingpool.Pool(processes=int(config['training_max_initialization_workers'] / config['training_batch_prep_subprocesses']), initializer=setupLocalLogging)
+            executionTraceArguments = [(traceId, session.id, configDir, applicationId) for session in executionSessions for traceId in session.executionTraces[:-1]]
 
-            executionTraceFutures = []
-            for session in executionSessions:
-                for traceId in session.executionTraces[:-1]:
-                    executionTraceFutures.append(initialDataLoadProcessPool.apply_async(TrainingManager.loadExecutionTraceWeightData, [traceId, session.id, configDir, applicationId]))
+            # The traces are sent to the workers in chunks, so the per-task overhead is shared across many small loads.
+            # Like the sessions, the results are kept in order.
+            executionTraceResults = initialDataLoadProcessPool.imap(TrainingManager.loadExecutionTraceWeightDataFromArguments, executionTraceArguments, chunksize=64)
 
-            completed = 0
-            for traceFuture in executionTraceFutures:
-                traceWeightData = pickle.loads(traceFuture.get(timeout=30))
+            for completed in range(1, len(executionTraceArguments) + 1):
+                traceWeightData = executionTraceResults.next(timeout=30)
                 if traceWeightData is not None:
                     executionTraceWeightDatas.append(traceWeightData)
                     executionTraceWeightDataIdMap[str(traceWeightData['id'])] = traceWeightData
-                completed += 1
                 if completed % 1000 == 0:
                     getLogger().info(f"[{os.getpid()}] Finished loading {completed} execution trace weight datas.")
 
@@ -724,20 +1220,39 @@ class TrainingManager:
 
             getLogger().info(f"[{os.getpid()}] Finished loading of weight datas for {len(executionTraceWeightDatas)} execution traces.")
 
-            del testingSteps, executionSessionIds, executionSessionFutures, executionSessions, executionTraceFutures
+            del testingSteps, executionSessionIds, executionSessions, executionTraceArguments, executionTraceResults
             getLogger().info(f"[{os.getpid()}] Finished initialization for batch preparation sub process.")
 
             if len(executionTraceWeightDatas) == 0:
                 subProcessBatchResultQueue.put("error")
                 raise RuntimeError("There are no execution trace weight datas to process in the algorithm.")
 
-            processPool = multiprocessingpool.Pool(processes=config['training_initial_batch_prep_workers'], initializer=setupLocalLogging)
-            backgroundTraceSaveProcessPool = multiprocessingpool.Pool(processes=config['training_background_trace_save_workers'], initializer=setupLocalLogging)
-            executionTraceSaveFutures = {}
+            # The weights are also kept in a single array, which is updated in place as the losses come in,
+            # so that it doesn't have to be rebuilt from the weight data dictionaries for every batch.
+            executionTraceWeights = numpy.fromiter((traceWeightData['weight'] for traceWeightData in executionTraceWeightDatas), dtype=numpy.float64, count=len(executionTraceWeightDatas))
+            executionTraceWeightIndexes = {str(traceWeightData['id']): index for index, traceWeightData in enumerate(executionTraceWeightDatas)}
+
+            processPool = multiprocessingpool.Pool(processes=config['training_initial_batch_prep_workers'], initializer=TrainingManager.initializeBatchPrepWorker, initargs=(configDir, applicationId, sharedMemoryPrefix))
+            # The trace weights are saved by long lived worker processes, each fed by its own queue. Each trace always goes
+            # to the same worker, so that the saves for a single trace are written in the order they were made.
+            traceWeightSaveQueues = []
+            traceWeightSaveProcesses = []
+            for saveWorkerIndex in range(config['training_background_trace_save_workers']):
+                traceWeightSaveQueue = multiprocessing.Queue(maxsize=10000)
+                traceWeightSaveProcess = multiprocessing.Process(target=TrainingManager.saveExecutionTraceWeightDataWorker, args=(traceWeightSaveQueue, configDir), daemon=True)
+                traceWeightSaveProcess.start()
+                traceWeightSaveQueues.append(traceWeightSaveQueue)
+                traceWeightSaveProcesses.append(traceWeightSaveProcess)
 
             batchCount = 0
             cacheFullState = True
 
+            # The selection distribution is only recomputed when one of the weights or the cache state changes
+            traceSelectionCdf = None
+
+            # The initial process pool is only used until the cache state is first evaluated. After that, batches are
+            # prepared by one of two long lived pools, one for when the cache is full and one for when it isn't.
+            batchPrepPools = {}
             lastProcessPool = None
             lastProcessPoolFutures = []
             currentProcessPoolFutures = []
@@ -747,72 +1262,97 @@ class TrainingManager:
 
             subProcessBatchResultQueue.put("ready")
 
-            cacheRateFutures = []
+            # The cache hit rates of the most recently completed batches. These are added by a callback on each batch's future.
+            recentCacheRates = collections.deque(maxlen=config['training_cache_full_state_moving_average_length'])
             with concurrent.futures.ThreadPoolExecutor(max_workers=config['training_max_batch_prep_thread_workers']) as threadExecutor:
                 while True:
-                    message, data = subProcessCommandQueue.get()
-                    if message == "quit":
+                    command = subProcessCommandQueue.get()
+                    if command[0] == TrainingManager.commandQuit:
                         break
-                    elif message == "starved":
+                    elif command[0] == TrainingManager.commandStarved:
                         starved = True
                         needToResetPool = True
-                    elif message == "full":
+                    elif command[0] == TrainingManager.commandFull:
                         starved = False
                         needToResetPool = True
-                    elif message == "batch":
-                        # See if we need to refresh the process pool. This is done to make sure resources get let go and to be able to switch between the smaller and larger process pool
+                    elif command[0] == TrainingManager.commandBatch:
+                        # See if we need to re-evaluate which process pool to use. This is done to be able to switch between the smaller and larger process pool
                         # Depending on the cache hit rate
                         if batchCount % config['training_reset_workers_every_n_batches'] == (config['training_reset_workers_every_n_batches'] - 1):
                             needToResetPool = True
 
-                        future = threadExecutor.submit(TrainingManager.prepareAndLoadSingleBatchForSubprocess, config, executionTraceWeightDatas, executionTraceWeightDataIdMap, batchDirectory, cacheFullState, processPool, subProcessCommandQueue,
-                                                       subProcessBatchResultQueue, applicationId)
-                        cacheRateFutures.append(future)
-                        currentProcessPoolFutures.append(future)
+                        if traceSelectionCdf is None:
+                            traceSelectionCdf = TrainingManager.computeTraceSelectionCdf(config, executionTraceWeights, cacheFullState)
+
+                        future = threadExecutor.submit(TrainingManager.prepareAndLoadSingleBatchForSubprocess, config, executionTraceWeightDatas, traceSelectionCdf, processPool, subProcessCommandQueue,
+                                                       subProcessBatchResultQueue, sharedMemoryPrefix)
+                        future.add_done_callback(lambda completedFuture: recentCacheRates.append(completedFuture.result()) if completedFuture.exception() is None else None)
+                        if processPool not in batchPrepPools.values():
+                            currentProcessPoolFutures.append(future)
 
                         batchCount += 1
-                    elif message == "update-loss":
-                        executionTraceId = data["executionTraceId"]
-                        sampleRewardLoss = data["sampleRewardLoss"]
-                        if executionTraceId in executionTraceWeightDataIdMap:
-                            traceWeightData = executionTraceWeightDataIdMap[executionTraceId]
-
-                            # We do this check here because saving execution traces is actually a pretty CPU heavy process,
-                            # so we only want to do it if the loss has actually changed by a significant degree
-                            differenceRatio = abs(traceWeightData['weight'] - sampleRewardLoss) / (traceWeightData['weight'] + 1e-6)
-                            if differenceRatio > config['training_trace_selection_min_loss_ratio_difference_for_save']:
-                                traceWeightData['weight'] = sampleRewardLoss
-                                if executionTraceId not in executionTraceSaveFutures or executionTraceSaveFutures[executionTraceId].ready():
-                                    traceSaveFuture = backgroundTraceSaveProcessPool.apply_async(TrainingManager.saveExecutionTraceWeightData, (traceWeightData, configDir))
-                                    executionTraceSaveFutures[executionTraceId] = traceSaveFuture
+                    elif command[0] == TrainingManager.commandUpdateLossBatch:
+                        opcode, executionTraceIds, sampleRewardLosses = command
+                        for executionTraceId, sampleRewardLoss in zip(executionTraceIds, sampleRewardLosses):
+                            if executionTraceId in executionTraceWeightDataIdMap:
+                                traceWeightData = executionTraceWeightDataIdMap[executionTraceId]
+                                sampleRewardLoss = float(sampleRewardLoss)
+
+                                # We do this check here because saving execution traces is actually a pretty CPU heavy process,
+                                # so we only want to do it if the loss has actually changed by a significant degree
+                                differenceRatio = abs(traceWeightData['weight'] - sampleRewardLoss) / (traceWeightData['weight'] + 1e-6)
+                                if differenceRatio > config['training_trace_selection_min_loss_ratio_difference_for_save']:
+                                    traceWeightData['weight'] = sampleRewardLoss
+                                    executionTraceWeights[executionTraceWeightIndexes[executionTraceId]] = sampleRewardLoss
+                                    traceSelectionCdf = None
+                                    try:
+                                        traceWeightSaveQueues[executionTraceWeightIndexes[executionTraceId] % len(traceWeightSaveQueues)].put_nowait(traceWeightData)
+                                    except queue.Full:
+                                        # If the save workers are falling behind we just skip this save. The weight is
+                                        # still updated in memory and will be saved the next time it changes.
+                                        pass
 
                     if needToResetPool and lastProcessPool is None:
                         needToResetPool = False
 
-                        cacheRates = [future.result() for future in cacheRateFutures[-config['training_cache_full_state_moving_average_length']:] if future.done()]
-
-                        # If the cache is full and the main process isn't starved for batches, we shrink the process pool down to a smaller size.
-                        if numpy.mean(cacheRates) > config['training_cache_full_state_min_cache_hit_rate'] and not starved:
-                            lastProcessPool = processPool
-                            lastProcessPoolFutures = list(currentProcessPoolFutures)
-                            currentProcessPoolFutures = []
-
-                            getLogger().debug(f"[{os.getpid()}] Resetting batch prep process pool. Cache full state. New workers: {config['training_cache_full_batch_prep_workers']}")
-
-                            processPool = multiprocessingpool.Pool(processes=config['training_cache_full_batch_prep_workers'], initializer=setupLocalLogging)
-
-                            cacheFullState = True
-                        # Otherwise we have a full sized process pool so we can plow through all the results.
+                        if len(recentCacheRates) > 0:
+                            averageCacheRate = sum(recentCacheRates) / len(recentCacheRates)
                         else:
-                            lastProcessPool = processPool
-                            lastProcessPoolFutures = list(currentProcessPoolFutures)
-                            currentProcessPoolFutures = []
-
-                            getLogger().debug(f"[{os.getpid()}] Resetting batch prep process pool. Cache starved state. New workers: {config['training_max_batch_prep_workers']}")
-
-                            processPool = multiprocessingpool.Pool(processes=config['training_max_batch_prep_workers'], initializer=setupLocalLogging)
-
-                            cacheFullState = False
+                            averageCacheRate = 0.0
+
+                        # If the cache is full and the main process isn't starved for batches, we switch to the smaller process pool.
+                        # Otherwise we use the full sized process pool so we can plow through all the results.
+                        newCacheFullState = bool(averageCacheRate > config['training_cache_full_state_min_cache_hit_rate'] and not starved)
+                        if newCacheFullState != cacheFullState:
+                            traceSelectionCdf = None
+                        cacheFullState = newCacheFullState
+
+                        if cacheFullState not in batchPrepPools:
+                            if cacheFullState:
+                                workers = config['training_cache_full_batch_prep_workers']
+                            else:
+                                workers = config['training_max_batch_prep_workers']
+
+                            getLogger().debug(f"[{os.getpid()}] Creating batch prep process pool. Cache full state: {cacheFullState}. Workers: {workers}")
+
+                            # The workers recycle themselves after a number of tasks, so that resources still get let go
+                            # without the parent having to tear down and recreate the whole pool. maxtasksperchild counts
+                            # tasks rather than batches. Every sample is a separate task, so on average each worker runs
+                            # batch_size / workers tasks per batch, and the limit is scaled up to match.
+                            tasksPerWorkerPerBatch = max(1, -(-config['batch_size'] // workers))
+                            batchPrepPools[cacheFullState] = multiprocessingpool.Pool(processes=workers, initializer=TrainingManager.initializeBatchPrepWorker, initargs=(configDir, applicationId, sharedMemoryPrefix),
+                                                                                      maxtasksperchild=config['training_reset_workers_every_n_batches'] * tasksPerWorkerPerBatch)
+
+                        if processPool is not batchPrepPools[cacheFullState]:
+                            getLogger().debug(f"[{os.getpid()}] Switching batch prep process pool. Cache full state: {cacheFullState}")
+
+                            # The initial pool is the only one that ever gets shut down, once its outstanding batches are finished
+                            if processPool not in batchPrepPools.values():
+                                lastProcessPool = processPool
+                                lastProcessPoolFutures = list(currentProcessPoolFutures)
+                                currentProcessPoolFutures = []
+
+                            processPool = batchPrepPools[cacheFullState]
 
                     if lastProcessPool is not None:
                         all = True
@@ -825,9 +1365,14 @@ class TrainingManager:
                             lastProcessPool = None
                             lastProcessPoolFutures = []
 
-            backgroundTraceSaveProcessPool.close()
-            backgroundTraceSaveProcessPool.join()
-            processPool.terminate()
+            for traceWeightSaveQueue in traceWeightSaveQueues:
+                traceWeightSaveQueue.put(None)
+            for traceWeightSaveProcess in traceWeightSaveProcesses:
+                traceWeightSaveProcess.join()
+            if processPool not in batchPrepPools.values():
+                processPool.terminate()
+            for batchPrepPool in batchPrepPools.values():
+                batchPrepPool.terminate()
             if lastProcessPool is not None:
                 lastProcessPool.terminate()
 
@@ -835,34 +1380,38 @@ class TrainingManager:
             getLogger().error(f"[{os.getpid()}] Error occurred in the batch preparation sub-process. Exiting. {traceback.format_exc()}")
 
     @staticmethod
-    def prepareAndLoadBatch(subProcessCommandQueue, subProcessBatchResultQueue):
-        subProcessCommandQueue.put(("batch", {}))
+    def prepareAndLoadBatch(subProcessCommandQueue, subProcessBatchResultQueue, pinMemory=False):
+        subProcessCommandQueue.put((TrainingManager.commandBatch,))
+
+        sharedBatch, cacheHit = subProcessBatchResultQueue.get()
+        batch = TrainingManager.loadSampleFromSharedMemory(sharedBatch)
 
-        batchFileName = subProcessBatchResultQueue.get()
-        with open(batchFileName, 'rb') as file:
-            batch, cacheHit = pickle.load(file)
-        os.unlink(batchFileName)
+        # Pinning is done here on the loader thread rather than in fetchBatchesForIteration,
+        # so the main training loop only ever receives batches that are ready for async transfer.
+        if pinMemory:
+            batch = DeepLearningAgent.pinBatchMemory(batch)
 
         return batch, cacheHit
 
     def printMovingAverageLosses(self):
-        movingAverageLength = int(self.config['print_loss_moving_average_length'])
-
-        averageStart = max(0, min(len(self.trainingStep.totalRewardLosses) - 1, movingAverageLength))
-
-        averageTotalRewardLoss = numpy.mean(self.trainingStep.totalRewardLosses[-averageStart:])
-        averagePresentRewardLoss = numpy.mean(self.trainingStep.presentRewardLosses[-averageStart:])
-        averageDiscountedFutureRewardLoss = numpy.mean(self.trainingStep.discountedFutureRewardLosses[-averageStart:])
-
-        averageStateValueLoss = numpy.mean(self.trainingStep.stateValueLosses[-averageStart:])
-        averageAdvantageLoss = numpy.mean(self.trainingStep.advantageLosses[-averageStart:])
-        averageActionProbabilityLoss = numpy.mean(self.trainingStep.actionProbabilityLosses[-averageStart:])
-
-        averageTracePredictionLoss = numpy.mean(self.trainingStep.tracePredictionLosses[-averageStart:])
-        averageExecutionFeatureLoss = numpy.mean(self.trainingStep.executionFeaturesLosses[-averageStart:])
-        averagePredictedCursorLoss = numpy.mean(self.trainingStep.predictedCursorLosses[-averageStart:])
-        averageTotalLoss = numpy.mean(self.trainingStep.totalLosses[-averageStart:])
-        averageTotalRebalancedLoss = numpy.mean(self.trainingStep.totalRebalancedLosses[-averageStart:])
+        averageStart = max(0, min(len(self.trainingStep.totalRewardLosses) - 1, self.printLossMovingAverageLength))
+
+        # All of the loss lists grow together, so their recent values can be stacked and averaged in a single call
+        averageTotalRewardLoss, averagePresentRewardLoss, averageDiscountedFutureRewardLoss, \
+        averageStateValueLoss, averageAdvantageLoss, averageActionProbabilityLoss, \
+        averageTracePredictionLoss, averageExecutionFeatureLoss, averagePredictedCursorLoss, \
+        averageTotalLoss = numpy.mean(numpy.array([
+            self.trainingStep.totalRewardLosses[-averageStart:],
+            self.trainingStep.presentRewardLosses[-averageStart:],
+            self.trainingStep.discountedFutureRewardLosses[-averageStart:],
+            self.trainingStep.stateValueLosses[-averageStart:],
+            self.trainingStep.advantageLosses[-averageStart:],
+            self.trainingStep.actionProbabilityLosses[-averageStart:],
+            self.trainingStep.tracePredictionLosses[-averageStart:],
+            self.trainingStep.executionFeaturesLosses[-averageStart:],
+            self.trainingStep.predictedCursorLosses[-averageStart:],
+            self.trainingStep.totalLosses[-averageStart:]
+        ], dtype=numpy.float64), axis=1).tolist()
 
         message = f"[{os.getpid()}] "
 
@@ -890,18 +1439,25 @@ class TrainingManager:
 
         return session
 
+    @staticmethod
+    def loadExecutionSessionInWorker(sessionId):
+        # This is run inside of a process pool created with TrainingManager.initializeWorker, so only the session id needs to be sent
+        return TrainingManager.loadExecutionSession(sessionId, workerProcessState['config'])
+
     @staticmethod
     def loadExecutionTrace(traceId, configDir):
-        config = KwolaCoreConfiguration(configDir)
+        config = TrainingManager.getWorkerConfig(configDir)
         trace = ExecutionTrace.loadFromDisk(traceId, config, omitLargeFields=True)
-        return pickle.dumps(trace)
+        return trace
 
     @staticmethod
     def loadExecutionTraceWeightData(traceId, sessionId, configDir, applicationId):
         try:
-            config = KwolaCoreConfiguration(configDir)
+            config = TrainingManager.getWorkerConfig(configDir)
 
-            weightFile = os.path.join(config.getKwolaUserDataDirectory("execution_trace_weight_files"), traceId + "-weight.json")
+            weightFileDir = config.getKwolaUserDataDirectory("execution_trace_weight_files")
+            weightFile = os.path.join(weightFileDir, traceId + "-weight.bin")
+            legacyWeightFile = os.path.join(weightFileDir, traceId + "-weight.json")
 
             data = {}
             useDefault = False
@@ -922,14 +1478,25 @@ class TrainingManager:
             #     getLogger().info(traceback.format_exc())
 
             try:
-                with open(weightFile, "rt") as f:
+                # The file is only 8 bytes, so it is read unbuffered, straight into a single bytes object
+                with open(weightFile, "rb", buffering=0) as f:
                     try:
-                        data = json.load(f)
+                        data = {"weight": struct.unpack("<d", f.read(8))[0]}
                         useDefault = False
-                    except json.JSONDecodeError:
+                    except struct.error:
                         useDefault = True
             except FileNotFoundError:
-                useDefault = True
+                # Fall back to the older JSON weight files. These are parsed straight from the
+                # raw bytes, without first decoding them through a text file wrapper.
+                try:
+                    with open(legacyWeightFile, "rb") as f:
+                        try:
+                            data = json.loads(f.read())
+                            useDefault = False
+                        except json.JSONDecodeError:
+                            useDefault = True
+                except FileNotFoundError:
+                    useDefault = True
 
             if useDefault:
                 data = {"weight": config['training_trace_selection_maximum_weight']}
@@ -938,7 +1505,12 @@ class TrainingManager:
             data['executionSessionId'] = sessionId
 
             # getLogger().info(f"Loaded {traceId}")
-            return pickle.dumps(data)
+            return data
         except Exception as e:
             getLogger().error(traceback.format_exc())
             return None
+
+    @staticmethod
+    def loadExecutionTraceWeightDataFromArguments(arguments):
+        # Pool.imap only passes a single argument, so this unpacks it for loadExecutionTraceWeightData
+        return TrainingManager.loadExecutionTraceWeightData(*arguments)
@@ -26,6 +26,7 @@ import json
 import os
 import psutil
 import subprocess
+import sys
 import threading
 import time
 import tempfile
@@ -42,23 +43,31 @@ class ManagedTaskSubprocess:
         They will also be monitored with a timeout and such.
     """
 
+    # Seeing either of these in the output means that the subprocess is finished. The traceback
+    # is here to catch when a python exception happens in the sub-process but it did not fully die
+    exitStrings = ["Traceback (most recent call last)", TaskProcess.resultFinishString]
+
     def __init__(self, args, data, timeout, config, logId):
         if logId is not None:
             self.logFilePath = os.path.join(config.getKwolaUserDataDirectory("logs"), logId + "_log.txt")
         else:
             self.logFilePath = tempfile.mktemp()
-        self.currentLogSize = 0
 
         self.args = args
         self.data = data
 
         self.processOutputFile = open(self.logFilePath, 'w')
+        self.logReader = None
         self.process = None
         self.startTime = datetime.now()
         self.alive = True
         self.timeout = timeout
 
-        self.output = ''
+        # The output is accumulated as a list of chunks, so that appending to it doesn't copy all
+        # of the output received so far.
+        self.outputChunks = []
+        self.outputLength = 0
+        self.outputHasExitString = False
 
         self.monitorTimeoutProcess = None
         self.monitorOutputProcess = None
@@ -66,6 +75,8 @@ class ManagedTaskSubprocess:
     def __del__(self):
         self.process.terminate()
         self.processOutputFile.close()
+        if self.logReader is not None:
+            self.logReader.close()
 
     def start(self):
         atexit.register(lambda: self.process.terminate())
@@ -75,6 +86,10 @@ class ManagedTaskSubprocess:
         self.process.stdin.write(bytes(json.dumps(self.data) + "\n", "utf8"))
         self.process.stdin.flush()
 
+        # A single handle is kept open for reading the log. Each read continues from where the last one
+        # left off, and just returns an empty string when there is no new output.
+        self.logReader = open(self.logFilePath, 'rt')
+
         self.monitorTimeoutProcess = threading.Thread(target=lambda: self.timeoutMonitoringThread(), daemon=True)
         self.monitorOutputProcess = threading.Thread(target=lambda: self.outputMonitoringThread(), daemon=True)
 
@@ -84,17 +99,12 @@ class ManagedTaskSubprocess:
 
 
     def getLatestLogOutput(self):
-        newSize = os.stat(self.logFilePath).st_size
+        data = self.logReader.read()
 
-        if newSize == self.currentLogSize:
-            return None
-        else:
-            file = open(self.logFilePath, 'rt')
-            file.seek(self.currentLogSize)
-            data = file.read()
-            self.currentLogSize += len(data)
-            file.close()
+        if data:
             return data
+        else:
+            return None
 
 
     def gracefullyTerminateProcess(self):
@@ -116,16 +126,67 @@ class ManagedTaskSubprocess:
 
     def stopProcessBothMethods(self):
         # First send it the terminate signal and hope it exits gracefully
+        # The waits return as soon as the process exits, rather than always sleeping for the full time.
         if self.process.returncode is None:
             self.gracefullyTerminateProcess()
-            time.sleep(3)
+            try:
+                self.process.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                pass
 
         # If it appears to still be running, give the entire tree of processes that this one touches a hard kill signal.
         # this should get the job done.
         if self.process.returncode is None:
             self.hardKillProcess()
-            time.sleep(1)
-
+            try:
+                self.process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                pass
+
+
+    @property
+    def output(self):
+        return "".join(self.outputChunks)
+
+    def appendOutput(self, text):
+        """
+            Adds newly read log output onto the captured output for this subprocess, and echoes it to standard output.
+            Backspace (DEL) characters in the text erase the character before them, which may have been received
+            in an earlier chunk.
+
+            :param text: The string of new output.
+        """
+        sys.stdout.write(text.replace(chr(127), ""))
+        sys.stdout.flush()
+
+        # Only the newly added output, plus enough of the previous output to catch an exit string that
+        # was split across two chunks, needs to be searched.
+        searchStart = max(0, self.outputLength - max(len(exitString) for exitString in self.exitStrings) + 1)
+
+        pieces = text.split(chr(127))
+        self.outputChunks.append(pieces[0])
+        self.outputLength += len(pieces[0])
+        for piece in pieces[1:]:
+            while len(self.outputChunks) > 0 and len(self.outputChunks[-1]) == 0:
+                self.outputChunks.pop()
+            if len(self.outputChunks) > 0:
+                self.outputChunks[-1] = self.outputChunks[-1][:-1]  # Erase the last character from the output.
+                self.outputLength -= 1
+            self.outputChunks.append(piece)
+            self.outputLength += len(piece)
+
+        searchStart = min(searchStart, self.outputLength)
+        tailChunks = []
+        tailLength = 0
+        for chunk in reversed(self.outputChunks):
+            if tailLength >= self.outputLength - searchStart:
+                break
+            tailChunks.append(chunk)
+            tailLength += len(chunk)
+        tail = "".join(reversed(tailChunks))
+
+        if any(exitString in tail for exitString in self.exitStrings):
+            self.outputHasExitString = True
 
     def extractResultFromOutput(self):
         if TaskProcess.resultStartString not in self.output or TaskProcess.resultFinishString not in self.output:
@@ -140,14 +201,8 @@ class ManagedTaskSubprocess:
             return result
 
     def doesOutputHaveExitString(self):
-        # This is here to catch when a python exception happens in the sub-process but it did not fully die
-        if "Traceback (most recent call last)" in self.output:
-            return True
-
-        if TaskProcess.resultFinishString in self.output:
-            return True
-
-        return False
+        # This is updated by appendOutput as each new chunk of output arrives
+        return self.outputHasExitString
 
     def waitForProcessResult(self):
         while self.alive:
@@ -162,18 +217,11 @@ class ManagedTaskSubprocess:
     def outputMonitoringThread(self):
         waitBetweenStdoutUpdates = 0.2
 
-        self.output = ''
         while self.process.returncode is None and (not self.doesOutputHaveExitString()) and self.alive:
             nextChars = self.getLatestLogOutput()
 
             if nextChars is not None:
-                for nextChar in nextChars:
-                    if nextChar == chr(127):
-                        self.output = self.output[:-1]  # Erase the last character from the self.output.
-                    else:
-                        self.output += nextChar
-                        print(nextChar, sep="", end="")
-                print("", sep="", end="", flush=True)
+                self.appendOutput(nextChars)
             else:
                 time.sleep(waitBetweenStdoutUpdates)
 
@@ -183,7 +231,10 @@ class ManagedTaskSubprocess:
 
         additionalOutput = self.getLatestLogOutput()
         if additionalOutput is not None:
-            self.output += additionalOutput
+            self.appendOutput(additionalOutput)
+
+        # Nothing else reads the log file once the process has finished, so it is closed now rather than waiting for __del__
+        self.logReader.close()
 
     def timeoutMonitoringThread(self):
         while self.alive:
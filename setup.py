@@ -28,6 +28,7 @@ here = os.path.abspath(os.path.dirname(__file__))
 requirements = [
     "mitmproxy",
     "mongoengine",
+    "numba",
     "numpy",
     "opencv-python",
     "pandas",
@@ -39,7 +40,7 @@ requirements = [
     "scipy",
     "selenium",
     "testtools",
-    "torch",
+    "torch>=2.3",
     "filetype",
     "billiard",
     "wheel",
@@ -70,7 +71,7 @@ setup(
             'config/prebuilt_configs/*.json'
         ]
     },
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     install_requires=requirements,
     entry_points={
         'console_scripts': [